@@ -50,6 +50,7 @@ import sys
 import torch
 import torch.nn as nn
 from torch.distributions import constraints
+from torch.nn.functional import embedding, pad
 
 from pyro.contrib.examples import polyphonic_data_loader as poly
 from pyro.infer.autoguide import AutoDelta
@@ -75,6 +76,22 @@ debug_handler.addFilter(filter=lambda record: record.levelno <= logging.DEBUG)
 log.addHandler(debug_handler)
 
 
+# Our prior on transition probabilities will be: stay in the same state with
+# 90% probability; uniformly jump to another state with 10% probability.
+# The concentration is a constant, so we build it once rather than on every
+# call to the model. The cache is keyed on the default dtype and device too,
+# since main() switches the default tensor type under --cuda.
+def transition_prior(hidden_dim):
+    return _transition_prior(
+        hidden_dim, torch.get_default_dtype(), torch.empty(0).device
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _transition_prior(hidden_dim, dtype, device):
+    return 0.9 * torch.eye(hidden_dim, dtype=dtype, device=device) + 0.1
+
+
 # Let's start with a simple Hidden Markov Model.
 #
 #     x[t-1] --> x[t] --> x[t+1]
@@ -95,12 +112,9 @@ def model_0(sequences, lengths, args, batch_size=None, include_prior=True):
     assert not torch._C._get_tracing_state()
     num_sequences, max_length, data_dim = sequences.shape
     with handlers.mask(mask=include_prior):
-        # Our prior on transition probabilities will be:
-        # stay in the same state with 90% probability; uniformly jump to another
-        # state with 10% probability.
         probs_x = pyro.sample(
             "probs_x",
-            dist.Dirichlet(0.9 * torch.eye(args.hidden_dim) + 0.1).to_event(1),
+            dist.Dirichlet(transition_prior(args.hidden_dim)).to_event(1),
         )
         # We put a weak prior on the conditional probability of a tone sounding.
         # We know that on average about 4 of 88 tones are active, so we'll set a
@@ -109,26 +123,29 @@ def model_0(sequences, lengths, args, batch_size=None, include_prior=True):
             "probs_y",
             dist.Beta(0.1, 0.9).expand([args.hidden_dim, data_dim]).to_event(2),
         )
+    # Bernoulli(probs) converts its probs to logits on every call, so we do
+    # that conversion once here, clamping as Bernoulli would.
+    logits_y = probs_y.logit(eps=torch.finfo(probs_y.dtype).eps)
     # In this first model we'll sequentially iterate over sequences in a
     # minibatch; this will make it easy to reason about tensor shapes.
     tones_plate = pyro.plate("tones", data_dim, dim=-1)
     for i in pyro.plate("sequences", len(sequences), batch_size):
         length = lengths[i]
         sequence = sequences[i, :length]
-        x = 0
+        x = torch.tensor(0)
         for t in pyro.markov(range(length)):
             # On the next line, we'll overwrite the value of x with an updated
             # value. If we wanted to record all x values, we could instead
             # write x[t] = pyro.sample(...x[t-1]...).
             x = pyro.sample(
                 "x_{}_{}".format(i, t),
-                dist.Categorical(probs_x[x]),
+                dist.Categorical(embedding(x, probs_x)),
                 infer={"enumerate": "parallel"},
             )
             with tones_plate:
                 pyro.sample(
                     "y_{}_{}".format(i, t),
-                    dist.Bernoulli(probs_y[x.squeeze(-1)]),
+                    dist.Bernoulli(logits=embedding(x.squeeze(-1), logits_y)),
                     obs=sequence[t],
                 )
 
@@ -193,19 +210,26 @@ def model_1(sequences, lengths, args, batch_size=None, include_prior=True):
     with handlers.mask(mask=include_prior):
         probs_x = pyro.sample(
             "probs_x",
-            dist.Dirichlet(0.9 * torch.eye(args.hidden_dim) + 0.1).to_event(1),
+            dist.Dirichlet(transition_prior(args.hidden_dim)).to_event(1),
         )
         probs_y = pyro.sample(
             "probs_y",
             dist.Beta(0.1, 0.9).expand([args.hidden_dim, data_dim]).to_event(2),
         )
+    logits_y = probs_y.logit(eps=torch.finfo(probs_y.dtype).eps)
     tones_plate = pyro.plate("tones", data_dim, dim=-1)
     # We subsample batch_size items out of num_sequences items. Note that since
     # we're using dim=-1 for the notes plate, we need to batch over a different
     # dimension, here dim=-2.
     with pyro.plate("sequences", num_sequences, batch_size, dim=-2) as batch:
         lengths = lengths[batch]
-        x = 0
+        sequences = sequences[batch]
+        # Build the mask for every time step once, rather than comparing t
+        # against lengths anew at each step of the loop below.
+        mask = (
+            torch.arange(max_length, device=lengths.device).unsqueeze(-1) < lengths
+        ).unsqueeze(-1)
+        x = torch.tensor(0)
         # If we are not using the jit, then we can vary the program structure
         # each call by running for a dynamically determined number of time
         # steps, lengths.max(). However if we are using the jit, then we try to
@@ -213,17 +237,17 @@ def model_1(sequences, lengths, args, batch_size=None, include_prior=True):
         # structure ends up being faster since each program structure would
         # need to trigger a new jit compile stage.
         for t in pyro.markov(range(max_length if args.jit else lengths.max())):
-            with handlers.mask(mask=(t < lengths).unsqueeze(-1)):
+            with handlers.mask(mask=mask[t]):
                 x = pyro.sample(
                     "x_{}".format(t),
-                    dist.Categorical(probs_x[x]),
+                    dist.Categorical(embedding(x, probs_x)),
                     infer={"enumerate": "parallel"},
                 )
                 with tones_plate:
                     pyro.sample(
                         "y_{}".format(t),
-                        dist.Bernoulli(probs_y[x.squeeze(-1)]),
-                        obs=sequences[batch, t],
+                        dist.Bernoulli(logits=embedding(x.squeeze(-1), logits_y)),
+                        obs=sequences[:, t],
                     )
 
 
@@ -280,21 +304,26 @@ def model_2(sequences, lengths, args, batch_size=None, include_prior=True):
     with handlers.mask(mask=include_prior):
         probs_x = pyro.sample(
             "probs_x",
-            dist.Dirichlet(0.9 * torch.eye(args.hidden_dim) + 0.1).to_event(1),
+            dist.Dirichlet(transition_prior(args.hidden_dim)).to_event(1),
         )
         probs_y = pyro.sample(
             "probs_y",
             dist.Beta(0.1, 0.9).expand([args.hidden_dim, 2, data_dim]).to_event(3),
         )
+    logits_y = probs_y.logit(eps=torch.finfo(probs_y.dtype).eps)
     tones_plate = pyro.plate("tones", data_dim, dim=-1)
     with pyro.plate("sequences", num_sequences, batch_size, dim=-2) as batch:
         lengths = lengths[batch]
-        x, y = 0, 0
+        sequences = sequences[batch]
+        mask = (
+            torch.arange(max_length, device=lengths.device).unsqueeze(-1) < lengths
+        ).unsqueeze(-1)
+        x = y = torch.tensor(0)
         for t in pyro.markov(range(max_length if args.jit else lengths.max())):
-            with handlers.mask(mask=(t < lengths).unsqueeze(-1)):
+            with handlers.mask(mask=mask[t]):
                 x = pyro.sample(
                     "x_{}".format(t),
-                    dist.Categorical(probs_x[x]),
+                    dist.Categorical(embedding(x, probs_x)),
                     infer={"enumerate": "parallel"},
                 )
                 # Note the broadcasting tricks here: to index probs_y on tensors x and y,
@@ -303,8 +332,8 @@ def model_2(sequences, lengths, args, batch_size=None, include_prior=True):
                 with tones_plate as tones:
                     y = pyro.sample(
                         "y_{}".format(t),
-                        dist.Bernoulli(probs_y[x, y, tones]),
-                        obs=sequences[batch, t],
+                        dist.Bernoulli(logits=logits_y[x, y, tones]),
+                        obs=sequences[:, t],
                     ).long()
 
 
@@ -331,36 +360,41 @@ def model_3(sequences, lengths, args, batch_size=None, include_prior=True):
     hidden_dim = int(args.hidden_dim**0.5)  # split between w and x
     with handlers.mask(mask=include_prior):
         probs_w = pyro.sample(
-            "probs_w", dist.Dirichlet(0.9 * torch.eye(hidden_dim) + 0.1).to_event(1)
+            "probs_w", dist.Dirichlet(transition_prior(hidden_dim)).to_event(1)
         )
         probs_x = pyro.sample(
-            "probs_x", dist.Dirichlet(0.9 * torch.eye(hidden_dim) + 0.1).to_event(1)
+            "probs_x", dist.Dirichlet(transition_prior(hidden_dim)).to_event(1)
         )
         probs_y = pyro.sample(
             "probs_y",
             dist.Beta(0.1, 0.9).expand([hidden_dim, hidden_dim, data_dim]).to_event(3),
         )
+    logits_y = probs_y.logit(eps=torch.finfo(probs_y.dtype).eps)
     tones_plate = pyro.plate("tones", data_dim, dim=-1)
     with pyro.plate("sequences", num_sequences, batch_size, dim=-2) as batch:
         lengths = lengths[batch]
-        w, x = 0, 0
+        sequences = sequences[batch]
+        mask = (
+            torch.arange(max_length, device=lengths.device).unsqueeze(-1) < lengths
+        ).unsqueeze(-1)
+        w = x = torch.tensor(0)
         for t in pyro.markov(range(max_length if args.jit else lengths.max())):
-            with handlers.mask(mask=(t < lengths).unsqueeze(-1)):
+            with handlers.mask(mask=mask[t]):
                 w = pyro.sample(
                     "w_{}".format(t),
-                    dist.Categorical(probs_w[w]),
+                    dist.Categorical(embedding(w, probs_w)),
                     infer={"enumerate": "parallel"},
                 )
                 x = pyro.sample(
                     "x_{}".format(t),
-                    dist.Categorical(probs_x[x]),
+                    dist.Categorical(embedding(x, probs_x)),
                     infer={"enumerate": "parallel"},
                 )
                 with tones_plate as tones:
                     pyro.sample(
                         "y_{}".format(t),
-                        dist.Bernoulli(probs_y[w, x, tones]),
-                        obs=sequences[batch, t],
+                        dist.Bernoulli(logits=logits_y[w, x, tones]),
+                        obs=sequences[:, t],
                     )
 
 
@@ -386,11 +420,11 @@ def model_4(sequences, lengths, args, batch_size=None, include_prior=True):
     hidden_dim = int(args.hidden_dim**0.5)  # split between w and x
     with handlers.mask(mask=include_prior):
         probs_w = pyro.sample(
-            "probs_w", dist.Dirichlet(0.9 * torch.eye(hidden_dim) + 0.1).to_event(1)
+            "probs_w", dist.Dirichlet(transition_prior(hidden_dim)).to_event(1)
         )
         probs_x = pyro.sample(
             "probs_x",
-            dist.Dirichlet(0.9 * torch.eye(hidden_dim) + 0.1)
+            dist.Dirichlet(transition_prior(hidden_dim))
             .expand_by([hidden_dim])
             .to_event(2),
         )
@@ -398,30 +432,38 @@ def model_4(sequences, lengths, args, batch_size=None, include_prior=True):
             "probs_y",
             dist.Beta(0.1, 0.9).expand([hidden_dim, hidden_dim, data_dim]).to_event(3),
         )
+    # Flattening the (w, x) pair into a single row index lets us look up the
+    # transition probabilities of x with one gather instead of a Vindex.
+    probs_x = probs_x.reshape(hidden_dim * hidden_dim, hidden_dim)
+    logits_y = probs_y.logit(eps=torch.finfo(probs_y.dtype).eps)
     tones_plate = pyro.plate("tones", data_dim, dim=-1)
     with pyro.plate("sequences", num_sequences, batch_size, dim=-2) as batch:
         lengths = lengths[batch]
+        sequences = sequences[batch]
+        mask = (
+            torch.arange(max_length, device=lengths.device).unsqueeze(-1) < lengths
+        ).unsqueeze(-1)
         # Note the broadcasting tricks here: we declare a hidden torch.arange and
         # ensure that w and x are always tensors so we can unsqueeze them below,
         # thus ensuring that the x sample sites have correct distribution shape.
         w = x = torch.tensor(0, dtype=torch.long)
         for t in pyro.markov(range(max_length if args.jit else lengths.max())):
-            with handlers.mask(mask=(t < lengths).unsqueeze(-1)):
+            with handlers.mask(mask=mask[t]):
                 w = pyro.sample(
                     "w_{}".format(t),
-                    dist.Categorical(probs_w[w]),
+                    dist.Categorical(embedding(w, probs_w)),
                     infer={"enumerate": "parallel"},
                 )
                 x = pyro.sample(
                     "x_{}".format(t),
-                    dist.Categorical(Vindex(probs_x)[w, x]),
+                    dist.Categorical(embedding(w * hidden_dim + x, probs_x)),
                     infer={"enumerate": "parallel"},
                 )
                 with tones_plate as tones:
                     pyro.sample(
                         "y_{}".format(t),
-                        dist.Bernoulli(probs_y[w, x, tones]),
-                        obs=sequences[batch, t],
+                        dist.Bernoulli(logits=logits_y[w, x, tones]),
+                        obs=sequences[:, t],
                     )
 
 
@@ -435,27 +477,31 @@ def model_4(sequences, lengths, args, batch_size=None, include_prior=True):
 # First let's define a neural net to generate y logits.
 class TonesGenerator(nn.Module):
     def __init__(self, args, data_dim):
-        self.args = args
-        self.data_dim = data_dim
         super().__init__()
+        self.data_dim = data_dim
         self.x_to_hidden = nn.Linear(args.hidden_dim, args.nn_dim)
         self.y_to_hidden = nn.Linear(args.nn_channels * data_dim, args.nn_dim)
         self.conv = nn.Conv1d(1, args.nn_channels, 3, padding=1)
         self.hidden_to_logits = nn.Linear(args.nn_dim, data_dim)
         self.relu = nn.ReLU()
 
-    def forward(self, x, y):
-        # Hidden units depend on two inputs: a one-hot encoded categorical variable x, and
-        # a bernoulli variable y. Whereas x will typically be enumerated, y will be observed.
-        # We apply x_to_hidden independently from y_to_hidden, then broadcast the non-enumerated
-        # y part up to the enumerated x part in the + operation.
-        x_onehot = y.new_zeros(x.shape[:-1] + (self.args.hidden_dim,)).scatter_(
-            -1, x, 1
-        )
+    def encode_tones(self, y):
+        # The hidden units' dependence on the observed tones y does not involve the
+        # enumerated variable x, so callers can encode y for all time steps at once.
         y_conv = self.relu(self.conv(y.reshape(-1, 1, self.data_dim))).reshape(
             y.shape[:-1] + (-1,)
         )
-        h = self.relu(self.x_to_hidden(x_onehot) + self.y_to_hidden(y_conv))
+        return self.y_to_hidden(y_conv)
+
+    def forward(self, x, y_hidden):
+        # Hidden units depend on two inputs: a one-hot encoded categorical variable x, and
+        # a bernoulli variable y. Whereas x will typically be enumerated, y will be observed.
+        # We apply x_to_hidden independently from the y encoding y_hidden, then broadcast
+        # the non-enumerated y part up to the enumerated x part in the + operation.
+        # Applying x_to_hidden to a one-hot vector simply selects a column of its weight,
+        # so we look that column up directly rather than materializing the one-hot x.
+        x_hidden = embedding(x.squeeze(-1), self.x_to_hidden.weight.t())
+        h = self.relu(x_hidden + self.x_to_hidden.bias + y_hidden)
         return self.hidden_to_logits(h)
 
 
@@ -481,26 +527,32 @@ def model_5(sequences, lengths, args, batch_size=None, include_prior=True):
     with handlers.mask(mask=include_prior):
         probs_x = pyro.sample(
             "probs_x",
-            dist.Dirichlet(0.9 * torch.eye(args.hidden_dim) + 0.1).to_event(1),
+            dist.Dirichlet(transition_prior(args.hidden_dim)).to_event(1),
         )
     with pyro.plate("sequences", num_sequences, batch_size, dim=-2) as batch:
         lengths = lengths[batch]
-        x = 0
-        y = torch.zeros(data_dim)
+        sequences = sequences[batch]
+        mask = (
+            torch.arange(max_length, device=lengths.device).unsqueeze(-1) < lengths
+        ).unsqueeze(-1)
+        x = torch.tensor(0)
+        # Since y is observed, we can encode the previous tones of every time step
+        # in a single batched pass, starting from silence at t = 0.
+        y_hidden = tones_generator.encode_tones(pad(sequences[:, :-1], (0, 0, 1, 0)))
         for t in pyro.markov(range(max_length if args.jit else lengths.max())):
-            with handlers.mask(mask=(t < lengths).unsqueeze(-1)):
+            with handlers.mask(mask=mask[t]):
                 x = pyro.sample(
                     "x_{}".format(t),
-                    dist.Categorical(probs_x[x]),
+                    dist.Categorical(embedding(x, probs_x)),
                     infer={"enumerate": "parallel"},
                 )
                 # Note that since each tone depends on all tones at a previous time step
                 # the tones at different time steps now need to live in separate plates.
                 with pyro.plate("tones_{}".format(t), data_dim, dim=-1):
-                    y = pyro.sample(
+                    pyro.sample(
                         "y_{}".format(t),
-                        dist.Bernoulli(logits=tones_generator(x, y)),
-                        obs=sequences[batch, t],
+                        dist.Bernoulli(logits=tones_generator(x, y_hidden[:, t])),
+                        obs=sequences[:, t],
                     )
 
 
@@ -555,31 +607,39 @@ def model_6(sequences, lengths, args, batch_size=None, include_prior=False):
         # (hidden_dim, 1, hidden_dim) to obtain a tensor of shape (hidden_dim, hidden_dim, hidden_dim)
         probs_x = mix_lambda * probs_x1 + (1.0 - mix_lambda) * probs_x2.unsqueeze(-2)
 
+    # As in model_4, flatten the (x_prev, x_curr) pair into a single row index.
+    probs_x = probs_x.reshape(hidden_dim * hidden_dim, hidden_dim)
+
     probs_y = pyro.param(
         "probs_y",
         torch.rand(hidden_dim, data_dim),
         constraint=constraints.unit_interval,
     )
+    logits_y = probs_y.logit(eps=torch.finfo(probs_y.dtype).eps)
     tones_plate = pyro.plate("tones", data_dim, dim=-1)
     with pyro.plate("sequences", num_sequences, batch_size, dim=-2) as batch:
         lengths = lengths[batch]
+        sequences = sequences[batch]
+        mask = (
+            torch.arange(max_length, device=lengths.device).unsqueeze(-1) < lengths
+        ).unsqueeze(-1)
         x_curr, x_prev = torch.tensor(0), torch.tensor(0)
         # we need to pass the argument `history=2' to `pyro.markov()`
         # since our model is now 2-markov
         for t in pyro.markov(range(lengths.max()), history=2):
-            with handlers.mask(mask=(t < lengths).unsqueeze(-1)):
-                probs_x_t = Vindex(probs_x)[x_prev, x_curr]
+            with handlers.mask(mask=mask[t]):
+                probs_x_t = embedding(x_prev * hidden_dim + x_curr, probs_x)
                 x_prev, x_curr = x_curr, pyro.sample(
                     "x_{}".format(t),
                     dist.Categorical(probs_x_t),
                     infer={"enumerate": "parallel"},
                 )
                 with tones_plate:
-                    probs_y_t = probs_y[x_curr.squeeze(-1)]
+                    logits_y_t = embedding(x_curr.squeeze(-1), logits_y)
                     pyro.sample(
                         "y_{}".format(t),
-                        dist.Bernoulli(probs_y_t),
-                        obs=sequences[batch, t],
+                        dist.Bernoulli(logits=logits_y_t),
+                        obs=sequences[:, t],
                     )
 
 
@@ -595,19 +655,20 @@ def model_7(sequences, lengths, args, batch_size=None, include_prior=True):
     with handlers.mask(mask=include_prior):
         probs_x = pyro.sample(
             "probs_x",
-            dist.Dirichlet(0.9 * torch.eye(args.hidden_dim) + 0.1).to_event(1),
+            dist.Dirichlet(transition_prior(args.hidden_dim)).to_event(1),
         )
         probs_y = pyro.sample(
             "probs_y",
             dist.Beta(0.1, 0.9).expand([args.hidden_dim, data_dim]).to_event(2),
         )
+    logits_y = probs_y.logit(eps=torch.finfo(probs_y.dtype).eps)
     tones_plate = pyro.plate("tones", data_dim, dim=-1)
     # Note that since we're using dim=-2 for the time dimension, we need
     # to batch sequences over a different dimension, here dim=-3.
     with pyro.plate("sequences", num_sequences, batch_size, dim=-3) as batch:
         lengths = lengths[batch]
         batch = batch[:, None]
-        x_prev = 0
+        x_prev = torch.tensor(0)
         # To vectorize time dimension we use pyro.vectorized_markov(name=...).
         # With the help of Vindex and additional unsqueezes we can ensure that
         # dimensions line up properly.
@@ -617,15 +678,16 @@ def model_7(sequences, lengths, args, batch_size=None, include_prior=True):
             with handlers.mask(mask=(t < lengths.unsqueeze(-1)).unsqueeze(-1)):
                 x_curr = pyro.sample(
                     "x_{}".format(t),
-                    dist.Categorical(probs_x[x_prev]),
+                    dist.Categorical(embedding(x_prev, probs_x)),
                     infer={"enumerate": "parallel"},
                 )
                 with tones_plate:
                     pyro.sample(
                         "y_{}".format(t),
-                        dist.Bernoulli(probs_y[x_curr.squeeze(-1)]),
+                        dist.Bernoulli(logits=embedding(x_curr.squeeze(-1), logits_y)),
                         obs=Vindex(sequences)[batch, t],
                     )
+            x_prev = x_curr
 
 
 # Let's see how vectorizing time dimension changes the shapes of sample sites:
@@ -644,11 +706,11 @@ def model_7(sequences, lengths, args, batch_size=None, include_prior=True):
 #                      value       16  1  1  1 |
 #                   y_0 dist       16 10  1 51 |
 #                      value          10  1 51 |
-#  x_slice(0, 71, None) dist          10 71  1 |
+#  x_slice(0, 71, None) dist       16 10 71  1 |
 #                      value    16  1  1  1  1 |
 #  y_slice(0, 71, None) dist    16  1 10 71 51 |
 #                      value          10 71 51 |
-#  x_slice(1, 72, None) dist          10 71  1 |
+#  x_slice(1, 72, None) dist    16  1 10 71  1 |
 #                      value 16  1  1  1  1  1 |
 #  y_slice(1, 72, None) dist 16  1  1 10 71 51 |
 #                      value          10 71 51 |
@@ -659,11 +721,188 @@ def model_7(sequences, lengths, args, batch_size=None, include_prior=True):
 # finally vectorized t_curr (torch.arange(1, 72)).
 
 
+# The same trick applies to the arHMM of model_2. Since y[t-1] is observed,
+# the only enumerated Markov variable is still x, and y_prev simply tracks the
+# observed tones of the previous (vectorized) time step: y_0 for the auxiliary
+# t_prev iteration and sequences[:, 0:T-1] for the t_curr iteration.
+def model_8(sequences, lengths, args, batch_size=None, include_prior=True):
+    with ignore_jit_warnings():
+        num_sequences, max_length, data_dim = map(int, sequences.shape)
+        assert lengths.shape == (num_sequences,)
+        assert lengths.max() <= max_length
+    with handlers.mask(mask=include_prior):
+        probs_x = pyro.sample(
+            "probs_x",
+            dist.Dirichlet(transition_prior(args.hidden_dim)).to_event(1),
+        )
+        probs_y = pyro.sample(
+            "probs_y",
+            dist.Beta(0.1, 0.9).expand([args.hidden_dim, 2, data_dim]).to_event(3),
+        )
+    logits_y = probs_y.logit(eps=torch.finfo(probs_y.dtype).eps)
+    tones_plate = pyro.plate("tones", data_dim, dim=-1)
+    with pyro.plate("sequences", num_sequences, batch_size, dim=-3) as batch:
+        lengths = lengths[batch]
+        batch = batch[:, None]
+        x_prev = y_prev = torch.tensor(0)
+        for t in pyro.vectorized_markov(
+            name="time", size=int(max_length if args.jit else lengths.max()), dim=-2
+        ):
+            with handlers.mask(mask=(t < lengths.unsqueeze(-1)).unsqueeze(-1)):
+                x_curr = pyro.sample(
+                    "x_{}".format(t),
+                    dist.Categorical(embedding(x_prev, probs_x)),
+                    infer={"enumerate": "parallel"},
+                )
+                with tones_plate as tones:
+                    y_curr = pyro.sample(
+                        "y_{}".format(t),
+                        dist.Bernoulli(logits=logits_y[x_curr, y_prev, tones]),
+                        obs=Vindex(sequences)[batch, t],
+                    ).long()
+            x_prev, y_prev = x_curr, y_curr
+
+
+# The sample sites of model_8 have the same shapes as those of model_7, except
+# for the larger probs_y table:
+# $ python examples/hmm.py -m 8 --funsor -n 1 --batch-size=10 --print-shapes
+# ...
+#              Sample Sites:
+#               probs_x dist                   | 16 16
+#                      value                   | 16 16
+#               probs_y dist                   | 16  2 51
+#                      value                   | 16  2 51
+#                 tones dist                   |
+#                      value                51 |
+#             sequences dist                   |
+#                      value                10 |
+#                   x_0 dist          10  1  1 |
+#                      value       16  1  1  1 |
+#                   y_0 dist       16 10  1 51 |
+#                      value          10  1 51 |
+#  x_slice(0, 71, None) dist       16 10 71  1 |
+#                      value    16  1  1  1  1 |
+#  y_slice(0, 71, None) dist    16  1 10 71 51 |
+#                      value          10 71 51 |
+#  x_slice(1, 72, None) dist    16  1 10 71  1 |
+#                      value 16  1  1  1  1  1 |
+#  y_slice(1, 72, None) dist 16  1  1 10 71 51 |
+#                      value          10 71 51 |
+#
+# Note that y_prev is not enumerated, so it only adds the batch and time
+# dimensions (10 71) that y_slice(1, 72, None) already has.
+
+
+# Vectorizing the Factorial HMM of model_3 requires tracking two Markov
+# variables w and x. pyro.vectorized_markov records both chains, and
+# TraceMarkovEnum_ELBO eliminates them jointly with the parallel scan.
+def model_9(sequences, lengths, args, batch_size=None, include_prior=True):
+    with ignore_jit_warnings():
+        num_sequences, max_length, data_dim = map(int, sequences.shape)
+        assert lengths.shape == (num_sequences,)
+        assert lengths.max() <= max_length
+    hidden_dim = int(args.hidden_dim**0.5)  # split between w and x
+    with handlers.mask(mask=include_prior):
+        probs_w = pyro.sample(
+            "probs_w", dist.Dirichlet(transition_prior(hidden_dim)).to_event(1)
+        )
+        probs_x = pyro.sample(
+            "probs_x", dist.Dirichlet(transition_prior(hidden_dim)).to_event(1)
+        )
+        probs_y = pyro.sample(
+            "probs_y",
+            dist.Beta(0.1, 0.9).expand([hidden_dim, hidden_dim, data_dim]).to_event(3),
+        )
+    logits_y = probs_y.logit(eps=torch.finfo(probs_y.dtype).eps)
+    tones_plate = pyro.plate("tones", data_dim, dim=-1)
+    with pyro.plate("sequences", num_sequences, batch_size, dim=-3) as batch:
+        lengths = lengths[batch]
+        batch = batch[:, None]
+        w_prev = x_prev = torch.tensor(0)
+        for t in pyro.vectorized_markov(
+            name="time", size=int(max_length if args.jit else lengths.max()), dim=-2
+        ):
+            with handlers.mask(mask=(t < lengths.unsqueeze(-1)).unsqueeze(-1)):
+                w_curr = pyro.sample(
+                    "w_{}".format(t),
+                    dist.Categorical(embedding(w_prev, probs_w)),
+                    infer={"enumerate": "parallel"},
+                )
+                x_curr = pyro.sample(
+                    "x_{}".format(t),
+                    dist.Categorical(embedding(x_prev, probs_x)),
+                    infer={"enumerate": "parallel"},
+                )
+                with tones_plate as tones:
+                    pyro.sample(
+                        "y_{}".format(t),
+                        dist.Bernoulli(logits=logits_y[w_curr, x_curr, tones]),
+                        obs=Vindex(sequences)[batch, t],
+                    )
+            w_prev, x_prev = w_curr, x_curr
+
+
+# Finally the Dynamic Bayesian Network of model_4, where x[t] depends on both
+# w[t] and x[t-1]. As in model_4 we flatten probs_x so that the transition
+# probabilities of x are looked up with a single embedding on both w and x.
+def model_10(sequences, lengths, args, batch_size=None, include_prior=True):
+    with ignore_jit_warnings():
+        num_sequences, max_length, data_dim = map(int, sequences.shape)
+        assert lengths.shape == (num_sequences,)
+        assert lengths.max() <= max_length
+    hidden_dim = int(args.hidden_dim**0.5)  # split between w and x
+    with handlers.mask(mask=include_prior):
+        probs_w = pyro.sample(
+            "probs_w", dist.Dirichlet(transition_prior(hidden_dim)).to_event(1)
+        )
+        probs_x = pyro.sample(
+            "probs_x",
+            dist.Dirichlet(transition_prior(hidden_dim))
+            .expand_by([hidden_dim])
+            .to_event(2),
+        )
+        probs_y = pyro.sample(
+            "probs_y",
+            dist.Beta(0.1, 0.9).expand([hidden_dim, hidden_dim, data_dim]).to_event(3),
+        )
+    probs_x = probs_x.reshape(hidden_dim * hidden_dim, hidden_dim)
+    logits_y = probs_y.logit(eps=torch.finfo(probs_y.dtype).eps)
+    tones_plate = pyro.plate("tones", data_dim, dim=-1)
+    with pyro.plate("sequences", num_sequences, batch_size, dim=-3) as batch:
+        lengths = lengths[batch]
+        batch = batch[:, None]
+        w_prev = x_prev = torch.tensor(0, dtype=torch.long)
+        for t in pyro.vectorized_markov(
+            name="time", size=int(max_length if args.jit else lengths.max()), dim=-2
+        ):
+            with handlers.mask(mask=(t < lengths.unsqueeze(-1)).unsqueeze(-1)):
+                w_curr = pyro.sample(
+                    "w_{}".format(t),
+                    dist.Categorical(embedding(w_prev, probs_w)),
+                    infer={"enumerate": "parallel"},
+                )
+                x_curr = pyro.sample(
+                    "x_{}".format(t),
+                    dist.Categorical(embedding(w_curr * hidden_dim + x_prev, probs_x)),
+                    infer={"enumerate": "parallel"},
+                )
+                with tones_plate as tones:
+                    pyro.sample(
+                        "y_{}".format(t),
+                        dist.Bernoulli(logits=logits_y[w_curr, x_curr, tones]),
+                        obs=Vindex(sequences)[batch, t],
+                    )
+            w_prev, x_prev = w_curr, x_curr
+
+
 models = {
     name[len("model_") :]: model
     for name, model in globals().items()
     if name.startswith("model_")
 }
+# These models vectorize time with pyro.vectorized_markov and hence require
+# the funsor backend and TraceMarkovEnum_ELBO.
+VECTORIZED_MODELS = ("7", "8", "9", "10")
 
 
 def main(args):
@@ -684,7 +923,7 @@ def main(args):
     lengths = data["train"]["sequence_lengths"]
 
     # find all the notes that are present at least once in the training set
-    present_notes = (sequences == 1).sum(0).sum(0) > 0
+    present_notes = (sequences == 1).flatten(0, 1).any(0)
     # remove notes that are never played (we remove 37/88 notes)
     sequences = sequences[..., present_notes]
 
@@ -709,7 +948,7 @@ def main(args):
     if args.print_shapes:
         if args.model == "0":
             first_available_dim = -2
-        elif args.model == "7":
+        elif args.model in VECTORIZED_MODELS:
             first_available_dim = -4
         else:
             first_available_dim = -3
@@ -741,7 +980,7 @@ def main(args):
         )  # noqa: E501
         svi = infer.SVI(tmc_model, guide, optimizer, elbo)
     else:
-        if args.model == "7":
+        if args.model in VECTORIZED_MODELS:
             assert args.funsor
             Elbo = (
                 infer.JitTraceMarkovEnum_ELBO
@@ -752,7 +991,7 @@ def main(args):
             Elbo = infer.JitTraceEnum_ELBO if args.jit else infer.TraceEnum_ELBO
         if args.model == "0":
             max_plate_nesting = 1
-        elif args.model == "7":
+        elif args.model in VECTORIZED_MODELS:
             max_plate_nesting = 3
         else:
             max_plate_nesting = 2
@@ -764,51 +1003,55 @@ def main(args):
         svi = infer.SVI(model, guide, optimizer, elbo)
 
     # We'll train on small minibatches.
+    # When jitting, we skip the graph executor's optimization passes, which
+    # take longer to run on these unrolled HMMs than they save per step. This
+    # covers both training and the train/test evaluations below.
     logging.info("Step\tLoss")
-    for step in range(args.num_steps):
-        loss = svi.step(sequences, lengths, batch_size=args.batch_size)
-        logging.info("{: >5d}\t{}".format(step, loss / num_observations))
-
-    if args.jit and args.time_compilation:
-        logging.debug(
-            "time to compile: {} s.".format(elbo._differentiable_loss.compile_time)
-        )
-
-    # We evaluate on the entire training dataset,
-    # excluding the prior term so our results are comparable across models.
-    train_loss = elbo.loss(
-        model,
-        guide,
-        sequences,
-        lengths,
-        batch_size=sequences.shape[0],
-        include_prior=False,
-    )
-    logging.info("training loss = {}".format(train_loss / num_observations))
+    with torch.jit.optimized_execution(not args.jit):
+        for step in range(args.num_steps):
+            loss = svi.step(sequences, lengths, batch_size=args.batch_size)
+            logging.info("{: >5d}\t{}".format(step, loss / num_observations))
+
+        if args.jit and args.time_compilation:
+            logging.debug(
+                "time to compile: {} s.".format(elbo._differentiable_loss.compile_time)
+            )
 
-    # Finally we evaluate on the test dataset.
-    logging.info("-" * 40)
-    logging.info(
-        "Evaluating on {} test sequences".format(len(data["test"]["sequences"]))
-    )
-    sequences = data["test"]["sequences"][..., present_notes]
-    lengths = data["test"]["sequence_lengths"]
-    if args.truncate:
-        lengths = lengths.clamp(max=args.truncate)
-    num_observations = float(lengths.sum())
+        # We evaluate on the entire training dataset,
+        # excluding the prior term so our results are comparable across models.
+        train_loss = elbo.loss(
+            model,
+            guide,
+            sequences,
+            lengths,
+            batch_size=sequences.shape[0],
+            include_prior=False,
+        )
+        logging.info("training loss = {}".format(train_loss / num_observations))
 
-    # note that since we removed unseen notes above (to make the problem a bit easier and for
-    # numerical stability) this test loss may not be directly comparable to numbers
-    # reported on this dataset elsewhere.
-    test_loss = elbo.loss(
-        model,
-        guide,
-        sequences,
-        lengths,
-        batch_size=sequences.shape[0],
-        include_prior=False,
-    )
-    logging.info("test loss = {}".format(test_loss / num_observations))
+        # Finally we evaluate on the test dataset.
+        logging.info("-" * 40)
+        logging.info(
+            "Evaluating on {} test sequences".format(len(data["test"]["sequences"]))
+        )
+        sequences = data["test"]["sequences"][..., present_notes]
+        lengths = data["test"]["sequence_lengths"]
+        if args.truncate:
+            lengths = lengths.clamp(max=args.truncate)
+        num_observations = float(lengths.sum())
+
+        # note that since we removed unseen notes above (to make the problem a bit easier and for
+        # numerical stability) this test loss may not be directly comparable to numbers
+        # reported on this dataset elsewhere.
+        test_loss = elbo.loss(
+            model,
+            guide,
+            sequences,
+            lengths,
+            batch_size=sequences.shape[0],
+            include_prior=False,
+        )
+        logging.info("test loss = {}".format(test_loss / num_observations))
 
     # We expect models with higher capacity to perform better,
     # but eventually overfit to the training set.
@@ -32,55 +32,61 @@ def terms_from_trace(tr):
         "log_factors": [],
         "log_measures": [],
         "scale": to_funsor(1.0),
-        "plate_vars": frozenset(),
-        "measure_vars": frozenset(),
+        "plate_vars": set(),
+        "measure_vars": set(),
         "plate_to_step": dict(),
     }
-    for name, node in tr.nodes.items():
+    nodes = tr.nodes
+    for name, node in nodes.items():
         # add markov dimensions to the plate_to_step dictionary
         if node["type"] == "markov_chain":
             terms["plate_to_step"][node["name"]] = node["value"]
             # ensure previous step variables are added to measure_vars
-            for step in node["value"]:
-                terms["measure_vars"] |= frozenset(
-                    {
-                        var
-                        for var in step[1:-1]
-                        if tr.nodes[var]["funsor"].get("log_measure", None) is not None
-                    }
-                )
+            terms["measure_vars"].update(
+                var
+                for step in node["value"]
+                for var in step[1:-1]
+                if nodes[var]["funsor"].get("log_measure", None) is not None
+            )
         if (
             node["type"] != "sample"
             or type(node["fn"]).__name__ == "_Subsample"
             or node["infer"].get("_do_not_score", False)
         ):
             continue
+        node_funsor = node["funsor"]
         # grab plate dimensions from the cond_indep_stack
-        terms["plate_vars"] |= frozenset(
+        terms["plate_vars"].update(
             f.name for f in node["cond_indep_stack"] if f.vectorized
         )
         # grab the log-measure, found only at sites that are not replayed or observed
-        if node["funsor"].get("log_measure", None) is not None:
-            terms["log_measures"].append(node["funsor"]["log_measure"])
+        log_measure = node_funsor.get("log_measure", None)
+        if log_measure is not None:
+            terms["log_measures"].append(log_measure)
             # sum (measure) variables: the fresh non-plate variables at a site
-            terms["measure_vars"] |= (
-                frozenset(node["funsor"]["value"].inputs) | {name}
-            ) - terms["plate_vars"]
+            terms["measure_vars"].update(
+                var
+                for var in node_funsor["value"].inputs
+                if var not in terms["plate_vars"]
+            )
+            terms["measure_vars"].add(name)
         # grab the scale, assuming a common subsampling scale
+        log_prob = node_funsor["log_prob"]
         if (
             node.get("replay_active", False)
-            and set(node["funsor"]["log_prob"].inputs) & terms["measure_vars"]
-            and float(to_data(node["funsor"]["scale"])) != 1.0
+            and not terms["measure_vars"].isdisjoint(log_prob.inputs)
+            and float(to_data(node_funsor["scale"])) != 1.0
         ):
             # model site that depends on enumerated variable: common scale
-            terms["scale"] = node["funsor"]["scale"]
-        else:  # otherwise: default scale behavior
-            node["funsor"]["log_prob"] = (
-                node["funsor"]["log_prob"] * node["funsor"]["scale"]
-            )
+            terms["scale"] = node_funsor["scale"]
+        else:  # otherwise: default scale behavior, leaving the trace untouched
+            log_prob = log_prob * node_funsor["scale"]
         # grab the log-density, found at all sites except those that are not replayed
         if node["is_observed"] or not node.get("replay_skipped", False):
-            terms["log_factors"].append(node["funsor"]["log_prob"])
+            terms["log_factors"].append(log_prob)
+    # the variable sets are built up in place above, and frozen once here
+    terms["plate_vars"] = frozenset(terms["plate_vars"])
+    terms["measure_vars"] = frozenset(terms["measure_vars"])
     # add plate dimensions to the plate_to_step dictionary
     terms["plate_to_step"].update(
         {plate: terms["plate_to_step"].get(plate, {}) for plate in terms["plate_vars"]}
@@ -118,10 +124,10 @@ class TraceMarkovEnum_ELBO(ELBO):
             # identify and contract out auxiliary variables in the model with partial_sum_product
             contracted_factors, uncontracted_factors = [], []
             for f in model_terms["log_factors"]:
-                if model_terms["measure_vars"].intersection(f.inputs):
-                    contracted_factors.append(f)
-                else:
+                if model_terms["measure_vars"].isdisjoint(f.inputs):
                     uncontracted_factors.append(f)
+                else:
+                    contracted_factors.append(f)
             # incorporate the effects of subsampling and handlers.scale through a common scale factor
             markov_dims = frozenset(
                 {plate for plate, step in model_terms["plate_to_step"].items() if step}
@@ -144,22 +150,20 @@ class TraceMarkovEnum_ELBO(ELBO):
             plate_vars = guide_terms["plate_vars"] | model_terms["plate_vars"]
             elbo = to_funsor(0, output=funsor.Real)
             for cost in costs:
+                input_vars = frozenset(cost.inputs)
                 # compute the marginal logq in the guide corresponding to this cost term
                 log_prob = funsor.sum_product.sum_product(
                     funsor.ops.logaddexp,
                     funsor.ops.add,
                     guide_terms["log_measures"],
                     plates=plate_vars,
-                    eliminate=(plate_vars | guide_terms["measure_vars"])
-                    - frozenset(cost.inputs),
+                    eliminate=(plate_vars | guide_terms["measure_vars"]) - input_vars,
                 )
                 # compute the expected cost term E_q[logp] or E_q[-logq] using the marginal logq for q
                 elbo_term = funsor.Integrate(
-                    log_prob, cost, guide_terms["measure_vars"] & frozenset(cost.inputs)
-                )
-                elbo += elbo_term.reduce(
-                    funsor.ops.add, plate_vars & frozenset(cost.inputs)
+                    log_prob, cost, guide_terms["measure_vars"] & input_vars
                 )
+                elbo += elbo_term.reduce(funsor.ops.add, plate_vars & input_vars)
 
         # evaluate the elbo, using memoize to share tensor computation where possible
         with funsor.interpretations.memoize():
@@ -190,10 +194,10 @@ class TraceEnum_ELBO(ELBO):
             # identify and contract out auxiliary variables in the model with partial_sum_product
             contracted_factors, uncontracted_factors = [], []
             for f in model_terms["log_factors"]:
-                if model_terms["measure_vars"].intersection(f.inputs):
-                    contracted_factors.append(f)
-                else:
+                if model_terms["measure_vars"].isdisjoint(f.inputs):
                     uncontracted_factors.append(f)
+                else:
+                    contracted_factors.append(f)
             # incorporate the effects of subsampling and handlers.scale through a common scale factor
             contracted_costs = [
                 model_terms["scale"] * f
@@ -215,46 +219,52 @@ class TraceEnum_ELBO(ELBO):
             # https://github.com/pyro-ppl/pyro/blob/0.3.0/pyro/infer/util.py#L212
             # TODO Replace this with funsor.Expectation
             plate_vars = guide_terms["plate_vars"] | model_terms["plate_vars"]
-            # compute the marginal logq in the guide corresponding to each cost term
-            targets = dict()
-            for cost in costs:
-                input_vars = frozenset(cost.inputs)
-                if input_vars not in targets:
-                    targets[input_vars] = funsor.Tensor(
-                        funsor.ops.new_zeros(
-                            funsor.tensor.get_default_prototype(),
-                            tuple(v.size for v in cost.inputs.values()),
-                        ),
-                        cost.inputs,
-                        cost.dtype,
-                    )
-            with AdjointTape() as tape:
-                logzq = funsor.sum_product.sum_product(
-                    funsor.ops.logaddexp,
-                    funsor.ops.add,
-                    guide_terms["log_measures"] + list(targets.values()),
-                    plates=plate_vars,
-                    eliminate=(plate_vars | guide_terms["measure_vars"]),
-                )
-            marginals = tape.adjoint(
-                funsor.ops.logaddexp, funsor.ops.add, logzq, tuple(targets.values())
-            )
-            # finally, integrate out guide variables in the elbo and all plates
             elbo = to_funsor(0, output=funsor.Real)
-            for cost in costs:
-                target = targets[frozenset(cost.inputs)]
-                logzq_local = marginals[target].reduce(
-                    funsor.ops.logaddexp, frozenset(cost.inputs) - plate_vars
-                )
-                log_prob = marginals[target] - logzq_local
-                elbo_term = funsor.Integrate(
-                    log_prob,
-                    cost,
-                    guide_terms["measure_vars"] & frozenset(log_prob.inputs),
-                )
-                elbo += elbo_term.reduce(
-                    funsor.ops.add, plate_vars & frozenset(cost.inputs)
+            if not guide_terms["measure_vars"]:
+                # without enumerated guide variables every marginal logq is trivial,
+                # so each cost enters the elbo as is and we can skip the AdjointTape
+                for cost in costs:
+                    elbo += cost.reduce(
+                        funsor.ops.add, plate_vars & frozenset(cost.inputs)
+                    )
+            else:
+                # compute the marginal logq in the guide corresponding to each cost term
+                cost_input_vars = [frozenset(cost.inputs) for cost in costs]
+                targets = dict()
+                for cost, input_vars in zip(costs, cost_input_vars):
+                    if input_vars not in targets:
+                        targets[input_vars] = funsor.Tensor(
+                            funsor.ops.new_zeros(
+                                funsor.tensor.get_default_prototype(),
+                                tuple(v.size for v in cost.inputs.values()),
+                            ),
+                            cost.inputs,
+                            cost.dtype,
+                        )
+                with AdjointTape() as tape:
+                    logzq = funsor.sum_product.sum_product(
+                        funsor.ops.logaddexp,
+                        funsor.ops.add,
+                        guide_terms["log_measures"] + list(targets.values()),
+                        plates=plate_vars,
+                        eliminate=(plate_vars | guide_terms["measure_vars"]),
+                    )
+                marginals = tape.adjoint(
+                    funsor.ops.logaddexp, funsor.ops.add, logzq, tuple(targets.values())
                 )
+                # finally, integrate out guide variables in the elbo and all plates
+                for cost, input_vars in zip(costs, cost_input_vars):
+                    target = targets[input_vars]
+                    logzq_local = marginals[target].reduce(
+                        funsor.ops.logaddexp, input_vars - plate_vars
+                    )
+                    log_prob = marginals[target] - logzq_local
+                    elbo_term = funsor.Integrate(
+                        log_prob,
+                        cost,
+                        guide_terms["measure_vars"] & frozenset(log_prob.inputs),
+                    )
+                    elbo += elbo_term.reduce(funsor.ops.add, plate_vars & input_vars)
 
         # evaluate the elbo, using memoize to share tensor computation where possible
         with funsor.interpretations.memoize():
@@ -5,6 +5,7 @@ import pytest
 import torch
 from pyroapi import pyro_backend
 from torch.distributions import constraints
+from torch.nn.functional import embedding
 
 from pyro.ops.indexing import Vindex
 
@@ -850,3 +851,332 @@ def test_guide_enumerated_elbo(model, guide, data, history):
         assert_close(actual_loss, expected_loss)
         for actual_grad, expected_grad in zip(actual_grads, expected_grads):
             assert_close(actual_grad, expected_grad)
+
+
+# The following are reduced versions of the HMMs in
+# examples/contrib/funsor/hmm.py. Each sequential model (as in model_1..model_4)
+# is paired with a model that vectorizes time (as in model_7..model_10) by
+# carrying explicit x_prev/x_curr pairs through pyro.vectorized_markov.
+def hmm_model_1(sequences, lengths):
+    x_dim, data_dim = 3, sequences.shape[-1]
+    probs_x = pyro.param(
+        "probs_x", lambda: torch.rand(x_dim, x_dim), constraint=constraints.simplex
+    )
+    probs_y = pyro.param(
+        "probs_y",
+        lambda: torch.rand(x_dim, data_dim),
+        constraint=constraints.unit_interval,
+    )
+    with pyro.plate("sequences", len(sequences), dim=-2) as batch:
+        x = torch.tensor(0)
+        for t in pyro.markov(range(int(lengths.max()))):
+            with handlers.mask(mask=(t < lengths).unsqueeze(-1)):
+                x = pyro.sample(
+                    "x_{}".format(t),
+                    dist.Categorical(embedding(x, probs_x)),
+                    infer={"enumerate": "parallel"},
+                )
+                with pyro.plate("tones", data_dim, dim=-1):
+                    pyro.sample(
+                        "y_{}".format(t),
+                        dist.Bernoulli(embedding(x.squeeze(-1), probs_y)),
+                        obs=sequences[batch, t],
+                    )
+
+
+def hmm_model_7(sequences, lengths):
+    x_dim, data_dim = 3, sequences.shape[-1]
+    probs_x = pyro.param(
+        "probs_x", lambda: torch.rand(x_dim, x_dim), constraint=constraints.simplex
+    )
+    probs_y = pyro.param(
+        "probs_y",
+        lambda: torch.rand(x_dim, data_dim),
+        constraint=constraints.unit_interval,
+    )
+    with pyro.plate("sequences", len(sequences), dim=-3) as batch:
+        batch = batch[:, None]
+        x_prev = torch.tensor(0)
+        for t in pyro.vectorized_markov(name="time", size=int(lengths.max()), dim=-2):
+            with handlers.mask(mask=(t < lengths.unsqueeze(-1)).unsqueeze(-1)):
+                x_curr = pyro.sample(
+                    "x_{}".format(t),
+                    dist.Categorical(embedding(x_prev, probs_x)),
+                    infer={"enumerate": "parallel"},
+                )
+                with pyro.plate("tones", data_dim, dim=-1):
+                    pyro.sample(
+                        "y_{}".format(t),
+                        dist.Bernoulli(embedding(x_curr.squeeze(-1), probs_y)),
+                        obs=Vindex(sequences)[batch, t],
+                    )
+            x_prev = x_curr
+
+
+def hmm_model_2(sequences, lengths):
+    x_dim, data_dim = 3, sequences.shape[-1]
+    probs_x = pyro.param(
+        "probs_x", lambda: torch.rand(x_dim, x_dim), constraint=constraints.simplex
+    )
+    probs_y = pyro.param(
+        "probs_y",
+        lambda: torch.rand(x_dim, 2, data_dim),
+        constraint=constraints.unit_interval,
+    )
+    with pyro.plate("sequences", len(sequences), dim=-2) as batch:
+        x, y = torch.tensor(0), torch.tensor(0)
+        for t in pyro.markov(range(int(lengths.max()))):
+            with handlers.mask(mask=(t < lengths).unsqueeze(-1)):
+                x = pyro.sample(
+                    "x_{}".format(t),
+                    dist.Categorical(embedding(x, probs_x)),
+                    infer={"enumerate": "parallel"},
+                )
+                with pyro.plate("tones", data_dim, dim=-1) as tones:
+                    y = pyro.sample(
+                        "y_{}".format(t),
+                        dist.Bernoulli(probs_y[x, y, tones]),
+                        obs=sequences[batch, t],
+                    ).long()
+
+
+def hmm_model_8(sequences, lengths):
+    x_dim, data_dim = 3, sequences.shape[-1]
+    probs_x = pyro.param(
+        "probs_x", lambda: torch.rand(x_dim, x_dim), constraint=constraints.simplex
+    )
+    probs_y = pyro.param(
+        "probs_y",
+        lambda: torch.rand(x_dim, 2, data_dim),
+        constraint=constraints.unit_interval,
+    )
+    with pyro.plate("sequences", len(sequences), dim=-3) as batch:
+        batch = batch[:, None]
+        x_prev = y_prev = torch.tensor(0)
+        for t in pyro.vectorized_markov(name="time", size=int(lengths.max()), dim=-2):
+            with handlers.mask(mask=(t < lengths.unsqueeze(-1)).unsqueeze(-1)):
+                x_curr = pyro.sample(
+                    "x_{}".format(t),
+                    dist.Categorical(embedding(x_prev, probs_x)),
+                    infer={"enumerate": "parallel"},
+                )
+                with pyro.plate("tones", data_dim, dim=-1) as tones:
+                    y_curr = pyro.sample(
+                        "y_{}".format(t),
+                        dist.Bernoulli(probs_y[x_curr, y_prev, tones]),
+                        obs=Vindex(sequences)[batch, t],
+                    ).long()
+            x_prev, y_prev = x_curr, y_curr
+
+
+def hmm_model_3(sequences, lengths):
+    hidden_dim, data_dim = 2, sequences.shape[-1]
+    probs_w = pyro.param(
+        "probs_w",
+        lambda: torch.rand(hidden_dim, hidden_dim),
+        constraint=constraints.simplex,
+    )
+    probs_x = pyro.param(
+        "probs_x",
+        lambda: torch.rand(hidden_dim, hidden_dim),
+        constraint=constraints.simplex,
+    )
+    probs_y = pyro.param(
+        "probs_y",
+        lambda: torch.rand(hidden_dim, hidden_dim, data_dim),
+        constraint=constraints.unit_interval,
+    )
+    with pyro.plate("sequences", len(sequences), dim=-2) as batch:
+        w, x = torch.tensor(0), torch.tensor(0)
+        for t in pyro.markov(range(int(lengths.max()))):
+            with handlers.mask(mask=(t < lengths).unsqueeze(-1)):
+                w = pyro.sample(
+                    "w_{}".format(t),
+                    dist.Categorical(embedding(w, probs_w)),
+                    infer={"enumerate": "parallel"},
+                )
+                x = pyro.sample(
+                    "x_{}".format(t),
+                    dist.Categorical(embedding(x, probs_x)),
+                    infer={"enumerate": "parallel"},
+                )
+                with pyro.plate("tones", data_dim, dim=-1) as tones:
+                    pyro.sample(
+                        "y_{}".format(t),
+                        dist.Bernoulli(probs_y[w, x, tones]),
+                        obs=sequences[batch, t],
+                    )
+
+
+def hmm_model_9(sequences, lengths):
+    hidden_dim, data_dim = 2, sequences.shape[-1]
+    probs_w = pyro.param(
+        "probs_w",
+        lambda: torch.rand(hidden_dim, hidden_dim),
+        constraint=constraints.simplex,
+    )
+    probs_x = pyro.param(
+        "probs_x",
+        lambda: torch.rand(hidden_dim, hidden_dim),
+        constraint=constraints.simplex,
+    )
+    probs_y = pyro.param(
+        "probs_y",
+        lambda: torch.rand(hidden_dim, hidden_dim, data_dim),
+        constraint=constraints.unit_interval,
+    )
+    with pyro.plate("sequences", len(sequences), dim=-3) as batch:
+        batch = batch[:, None]
+        w_prev = x_prev = torch.tensor(0)
+        for t in pyro.vectorized_markov(name="time", size=int(lengths.max()), dim=-2):
+            with handlers.mask(mask=(t < lengths.unsqueeze(-1)).unsqueeze(-1)):
+                w_curr = pyro.sample(
+                    "w_{}".format(t),
+                    dist.Categorical(embedding(w_prev, probs_w)),
+                    infer={"enumerate": "parallel"},
+                )
+                x_curr = pyro.sample(
+                    "x_{}".format(t),
+                    dist.Categorical(embedding(x_prev, probs_x)),
+                    infer={"enumerate": "parallel"},
+                )
+                with pyro.plate("tones", data_dim, dim=-1) as tones:
+                    pyro.sample(
+                        "y_{}".format(t),
+                        dist.Bernoulli(probs_y[w_curr, x_curr, tones]),
+                        obs=Vindex(sequences)[batch, t],
+                    )
+            w_prev, x_prev = w_curr, x_curr
+
+
+def hmm_model_4(sequences, lengths):
+    hidden_dim, data_dim = 2, sequences.shape[-1]
+    probs_w = pyro.param(
+        "probs_w",
+        lambda: torch.rand(hidden_dim, hidden_dim),
+        constraint=constraints.simplex,
+    )
+    probs_x = pyro.param(
+        "probs_x",
+        lambda: torch.rand(hidden_dim, hidden_dim, hidden_dim),
+        constraint=constraints.simplex,
+    )
+    probs_y = pyro.param(
+        "probs_y",
+        lambda: torch.rand(hidden_dim, hidden_dim, data_dim),
+        constraint=constraints.unit_interval,
+    )
+    with pyro.plate("sequences", len(sequences), dim=-2) as batch:
+        w, x = torch.tensor(0), torch.tensor(0)
+        for t in pyro.markov(range(int(lengths.max()))):
+            with handlers.mask(mask=(t < lengths).unsqueeze(-1)):
+                w = pyro.sample(
+                    "w_{}".format(t),
+                    dist.Categorical(embedding(w, probs_w)),
+                    infer={"enumerate": "parallel"},
+                )
+                x = pyro.sample(
+                    "x_{}".format(t),
+                    dist.Categorical(Vindex(probs_x)[w, x]),
+                    infer={"enumerate": "parallel"},
+                )
+                with pyro.plate("tones", data_dim, dim=-1) as tones:
+                    pyro.sample(
+                        "y_{}".format(t),
+                        dist.Bernoulli(probs_y[w, x, tones]),
+                        obs=sequences[batch, t],
+                    )
+
+
+def hmm_model_10(sequences, lengths):
+    hidden_dim, data_dim = 2, sequences.shape[-1]
+    probs_w = pyro.param(
+        "probs_w",
+        lambda: torch.rand(hidden_dim, hidden_dim),
+        constraint=constraints.simplex,
+    )
+    probs_x = pyro.param(
+        "probs_x",
+        lambda: torch.rand(hidden_dim, hidden_dim, hidden_dim),
+        constraint=constraints.simplex,
+    )
+    probs_y = pyro.param(
+        "probs_y",
+        lambda: torch.rand(hidden_dim, hidden_dim, data_dim),
+        constraint=constraints.unit_interval,
+    )
+    probs_x = probs_x.reshape(hidden_dim * hidden_dim, hidden_dim)
+    with pyro.plate("sequences", len(sequences), dim=-3) as batch:
+        batch = batch[:, None]
+        w_prev = x_prev = torch.tensor(0)
+        for t in pyro.vectorized_markov(name="time", size=int(lengths.max()), dim=-2):
+            with handlers.mask(mask=(t < lengths.unsqueeze(-1)).unsqueeze(-1)):
+                w_curr = pyro.sample(
+                    "w_{}".format(t),
+                    dist.Categorical(embedding(w_prev, probs_w)),
+                    infer={"enumerate": "parallel"},
+                )
+                x_curr = pyro.sample(
+                    "x_{}".format(t),
+                    dist.Categorical(embedding(w_curr * hidden_dim + x_prev, probs_x)),
+                    infer={"enumerate": "parallel"},
+                )
+                with pyro.plate("tones", data_dim, dim=-1) as tones:
+                    pyro.sample(
+                        "y_{}".format(t),
+                        dist.Bernoulli(probs_y[w_curr, x_curr, tones]),
+                        obs=Vindex(sequences)[batch, t],
+                    )
+            w_prev, x_prev = w_curr, x_curr
+
+
+def guide_empty_hmm(sequences, lengths):
+    pass
+
+
+@pytest.mark.parametrize(
+    "model,vectorized_model",
+    [
+        (hmm_model_1, hmm_model_7),
+        (hmm_model_2, hmm_model_8),
+        (hmm_model_3, hmm_model_9),
+        (hmm_model_4, hmm_model_10),
+    ],
+)
+def test_hmm_vectorized_elbo(model, vectorized_model):
+    pyro.clear_param_store()
+    sequences = torch.rand(3, 6, 5).round()
+    lengths = torch.tensor([6, 4, 2])
+
+    with pyro_backend("contrib.funsor"):
+        elbo = infer.TraceEnum_ELBO(max_plate_nesting=2)
+        expected_loss = elbo.loss(model, guide_empty_hmm, sequences, lengths)
+
+        vectorized_elbo = infer.TraceMarkovEnum_ELBO(max_plate_nesting=3)
+        actual_loss = vectorized_elbo.loss(
+            vectorized_model, guide_empty_hmm, sequences, lengths
+        )
+
+    assert_close(actual_loss, expected_loss)
+
+
+def test_terms_from_trace_leaves_trace_unscaled():
+    data = torch.tensor([0.0, 1.0, 1.0, 0.0])
+
+    def model():
+        with pyro.plate("data", 4, subsample_size=2) as ind:
+            pyro.sample("x", dist.Bernoulli(0.3), obs=data[ind])
+
+    with pyro_backend("contrib.funsor"):
+        with handlers.enum():
+            trace = handlers.trace(model).get_trace()
+
+    log_prob = trace.nodes["x"]["funsor"]["log_prob"]
+    expected = terms_from_trace(trace)["log_factors"]
+    actual = terms_from_trace(trace)["log_factors"]
+
+    # the subsampling scale of 2 is applied to the terms, not to the trace
+    assert trace.nodes["x"]["funsor"]["log_prob"] is log_prob
+    assert len(expected) == len(actual) == 1
+    assert_close(expected[0], log_prob * 2.0)
+    assert_close(actual[0], expected[0])
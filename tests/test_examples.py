@@ -291,8 +291,13 @@ FUNSOR_EXAMPLES = [
     "contrib/funsor/hmm.py --num-steps=1 --truncate=10 --model=5 --funsor",
     "contrib/funsor/hmm.py --num-steps=1 --truncate=10 --model=6 --funsor",
     "contrib/funsor/hmm.py --num-steps=1 --truncate=10 --model=6 --raftery-parameterization --funsor",
+    "contrib/funsor/hmm.py --num-steps=1 --truncate=10 --model=7 --funsor",
+    "contrib/funsor/hmm.py --num-steps=1 --truncate=10 --model=8 --funsor",
+    "contrib/funsor/hmm.py --num-steps=1 --truncate=10 --model=9 --funsor",
+    "contrib/funsor/hmm.py --num-steps=1 --truncate=10 --model=10 --funsor",
     "contrib/funsor/hmm.py --num-steps=1 --truncate=10 --model=6 --jit --funsor",
     "contrib/funsor/hmm.py --num-steps=1 --truncate=10 --model=6 --jit --raftery-parameterization --funsor",
+    "contrib/funsor/hmm.py --num-steps=1 --truncate=10 --model=8 --jit --funsor",
     xfail_param(
         "contrib/funsor/hmm.py --num-steps=1 --truncate=10 --model=0 --tmc --tmc-num-samples=2 --funsor",
         reason="unreproducible recursion error on travis?",